@@ -0,0 +1,119 @@
+# Parameter converters. Each takes a value from a front-end request and
+# returns it as the type the HyperDeck expects, raising TypeError or
+# ValueError if it can't be converted.
+def boolean(value):
+    if not isinstance(value, bool):
+        raise TypeError("expected a boolean")
+    return value
+
+
+def integer(value):
+    if isinstance(value, bool):
+        raise TypeError("expected an integer")
+    return int(value)
+
+
+def number(value):
+    if isinstance(value, bool):
+        raise TypeError("expected a number")
+    return float(value)
+
+
+def string(value):
+    if not isinstance(value, str):
+        raise TypeError("expected a string")
+    return value
+
+
+def array(value):
+    if not isinstance(value, list):
+        raise TypeError("expected a list")
+    return value
+
+
+def anything(value):
+    return value
+
+
+def compile_params(spec):
+    # Turns a {name: (converter, default)} spec into a function that checks
+    # and converts a request's params in a single pass, filling in defaults
+    # for missing (or null) params. Unknown params are ignored.
+    fields = tuple((name, convert, default) for (name, (convert, default)) in spec.items())
+
+    def parse(params):
+        if params is None:
+            params = dict()
+        elif not isinstance(params, dict):
+            raise ValueError("params must be an object")
+
+        parsed = dict()
+        for (name, convert, default) in fields:
+            value = params.get(name, None)
+            if value is None:
+                parsed[name] = default
+                continue
+            try:
+                parsed[name] = convert(value)
+            except (TypeError, ValueError) as e:
+                raise ValueError("invalid '{}' param {!r}: {}".format(name, value, e))
+        return parsed
+
+    return parse
+
+
+no_params = compile_params({})
+
+# HyperDeck actions the front-end can run, either directly or as batch steps.
+# Each maps a command name to a function taking the HyperDeck and the parsed
+# params, and the compiled params it accepts. Actions return True when the
+# HyperDeck accepted the command.
+actions = {
+    'record': (
+        lambda hyperdeck, params: hyperdeck.record(),
+        no_params),
+    'record_named': (
+        lambda hyperdeck, params: hyperdeck.record_named(params['clip_name']),
+        compile_params({'clip_name': (string, '')})),
+    'play': (
+        lambda hyperdeck, params: hyperdeck.play(
+            single=params['single'], loop=params['loop'], speed=params['speed']),
+        compile_params({'single': (boolean, False), 'loop': (boolean, False), 'speed': (number, 1.0)})),
+    'stop': (
+        lambda hyperdeck, params: hyperdeck.stop(),
+        no_params),
+    'state_refresh': (
+        lambda hyperdeck, params: hyperdeck.update_status(),
+        no_params),
+    'clip_select': (
+        lambda hyperdeck, params: hyperdeck.select_clip_by_index(params['id']),
+        compile_params({'id': (integer, 0)})),
+    'clip_refresh': (
+        lambda hyperdeck, params: hyperdeck.update_clips(),
+        no_params),
+    'clip_previous': (
+        lambda hyperdeck, params: hyperdeck.select_clip_by_offset(-1),
+        no_params),
+    'clip_next': (
+        lambda hyperdeck, params: hyperdeck.select_clip_by_offset(1),
+        no_params),
+    'clip_jog': (
+        lambda hyperdeck, params: hyperdeck.jog_to_timecode(params['timecode']),
+        compile_params({'timecode': (string, '00:00:00;00')})),
+    'slot_info': (
+        lambda hyperdeck, params: hyperdeck.slot_info(params['slot']),
+        compile_params({'slot': (integer, None)})),
+    'slot_select': (
+        lambda hyperdeck, params: hyperdeck.slot_select(params['slot']),
+        compile_params({'slot': (integer, 1)})),
+    'dist_list': (
+        lambda hyperdeck, params: hyperdeck.dist_list(params['slot']),
+        compile_params({'slot': (integer, None)})),
+    'slot_refresh': (
+        lambda hyperdeck, params: hyperdeck.update_slots(),
+        no_params),
+}
+
+# Actions that only refresh our caches, these succeed regardless of their
+# (None) return value.
+refresh_actions = ('state_refresh', 'clip_refresh', 'slot_refresh')
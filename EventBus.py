@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from collections import namedtuple
+
+# Event types published by the HyperDeck.
+CLIPS = 'clips'
+STATUS = 'status'
+SLOTS = 'slots'
+TRANSCRIPT = 'transcript'
+ERROR = 'error'
+
+Event = namedtuple('Event', ['type', 'params'])
+
+
+class Subscription:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, bus, events=None, maxsize=100):
+        self.events = None if events is None else frozenset(events)
+        self.dropped = 0
+
+        self._bus = bus
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._closed = False
+
+    def wants(self, event_type):
+        return self.events is None or event_type in self.events
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def put(self, event):
+        if self._closed:
+            return
+
+        # Never block the publisher: if this subscriber has fallen behind,
+        # discard its oldest queued event to make room for the newest one.
+        if self._queue.full():
+            try:
+                self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                self.logger.warning(
+                    "Slow subscriber, {} event(s) dropped.".format(self.dropped))
+
+        self._queue.put_nowait(event)
+
+    async def get(self):
+        return await self._queue.get()
+
+    def close(self):
+        # Wake up any consumer waiting on this subscription and detach it
+        # from the bus.
+        if self._closed:
+            return
+        self._closed = True
+        self._bus.unsubscribe(self)
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+class EventBus:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        self._subscriptions = []
+
+    def subscribe(self, events=None, maxsize=100):
+        # Returns a new subscription receiving the given event types (or all
+        # events if none are given) through its own bounded queue.
+        subscription = Subscription(self, events=events, maxsize=maxsize)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    def subscriberCount(self):
+        return len(self._subscriptions)
+
+    def publish(self, event_type, params=None):
+        # Deliver the event to every interested subscriber without waiting on
+        # any of them.
+        event = Event(event_type, params)
+        for subscription in self._subscriptions:
+            if subscription.wants(event_type):
+                subscription.put(event)
+
+    def close(self):
+        for subscription in list(self._subscriptions):
+            subscription.close()
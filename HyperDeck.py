@@ -1,45 +1,102 @@
 import asyncio
+import contextvars
 import logging
+import time
+from collections import deque
 
-status_timeout = 600
+import EventBus
+import Trace
+
+# Status poll intervals (in seconds): while the HyperDeck is recording or
+# moving, while it is stopped with someone watching, and while nobody is
+# watching at all.
+fast_poll_interval = 0.2
+slow_poll_interval = 1
+idle_poll_interval = 600
+
+# While the HyperDeck isn't answering status polls (within poll_timeout
+# seconds), the poll interval doubles each time up to max_poll_backoff.
+poll_timeout = 5
+max_poll_backoff = 30
+
+# Media slots of the HyperDeck, whose inventory is cached.
+slot_ids = (1, 2)
+
+# Transport states polled at the fast interval.
+active_states = frozenset(['record', 'play', 'forward', 'rewind', 'jog', 'shuttle'])
+
+# Latency trace of the front-end request currently being handled, if any. The
+# WebUI sets this to a dict while it handles a request carrying an id, and
+# every command sent on its behalf records its hop timestamps in it.
+request_timing = contextvars.ContextVar('request_timing', default=None)
 
 class HyperDeck:
     logger = logging.getLogger(__name__)
 
-    def __init__(self, host=None, port=None, loop=None):
+    def __init__(self, host=None, port=None, loop=None, events=None, trace=None):
         self.host = host or '192.168.21.64'
         self.port = port or 9993
         self.clips = []
         self.status = dict()
+        self.slots = dict()
+        self.events = events or EventBus.EventBus()
 
         self.do_while = False
-        self._loop = loop or asyncio.get_event_loop()
+        self._loop = loop
+        self._closing = False
+        self._tasks = set()
+        self._trace = trace
         self._transport = None
-        self._callback = None
-        self._response_future = None
+        self._responses = deque()
+        self._state = 'disconnected'
+        self._lastResponseTime = None
         self._socketCount = 0
-        self._statusCount = status_timeout
+        self._parser = None
+        self._poller = None
+        self._pollWake = None
+        self._autoRefresh = True
 
     def connectedSockets(self, count=0):
         if count is not None and (type(count) == int or type(count) == float):
+            # Poll straight away when the first viewer arrives, rather than
+            # at the end of the idle interval.
+            if self._socketCount <= 0 and count > 0 and self._pollWake is not None:
+                self._pollWake.set()
             self._socketCount = count;
         return self._socketCount
 
+    def isConnected(self):
+        # Cached connection state, this does not talk to the HyperDeck.
+        return self.do_while and self._transport is not None and not self._transport[1].is_closing()
+
+    def health(self):
+        # Snapshot of the cached connection state, this does not talk to the
+        # HyperDeck so it is cheap enough to call on every health probe.
+        now = time.monotonic()
+        oldest = self._responses[0][1] if self._responses else None
+        return {
+            'host': self.host,
+            'port': self.port,
+            'state': self._state,
+            'connected': self.isConnected(),
+            'pending_commands': len(self._responses),
+            'command_age': None if oldest is None else now - oldest,
+            'last_response_age': None if self._lastResponseTime is None else now - self._lastResponseTime,
+        }
+
     def getHost(self):
         return self.host
 
     def getPort(self):
         return self.port
 
-    def hasCallback(self):
-        return False if self._callback is None else True
-
     async def setNetwork(self, host=None, port=None):
         # Update the host and/or port and re-connect to the HyperDeck
         if host == None or port == None:
             return
 
         if self._transport:
+            self._detach()
             self._transport[1].close()
             await self._transport[1].wait_closed()
 
@@ -48,34 +105,46 @@ class HyperDeck:
 
         await self.reconnect(1);
 
-    async def set_callback(self, callback):
-        # This callback is invoked each time the HyperDeck's state changes.
-        self._callback = callback
+    def _create_task(self, coro):
+        # Keep a reference to every background worker, so they can't be
+        # garbage collected mid-flight and can be cancelled on shutdown.
+        # Workers outlive the request that may have started them, so they
+        # must not inherit its latency trace.
+        token = request_timing.set(None)
+        try:
+            task = self._loop.create_task(coro)
+        finally:
+            request_timing.reset(token)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
 
     async def connect(self):
+        if self._closing:
+            return None
+
+        self._loop = self._loop or asyncio.get_running_loop()
+
         self.logger.info(
             'Connecting to {}:{}...'.format(self.host, self.port))
 
         try:
             if self._transport:
+                self._detach()
                 self._transport[1].close()
                 await self._transport[1].wait_closed()
         except Exception as e:
             self.logger.error("Failed to close current connection: {}".format(e))
+        self._fail_responses()
 
         try:
             self.do_while = True
-            self._transport = await asyncio.open_connection(host=self.host, port=self.port, loop=self._loop)
+            self._state = 'connecting'
+            (reader, writer) = await asyncio.open_connection(host=self.host, port=self.port)
             self.logger.info('Connection established.')
-
-            # Set up a worker task to receive and parse responses from the
-            # Hyperdeck:
-            self._loop.create_task(self._parse_responses())
-
-            # Set up a worker task to periodically poll the HyperDeck state, so
-            # we can keep track of what it is currently doing:
-            self._loop.create_task(self._poll_state())
+            self.attach(reader, writer)
         except Exception as e:
+            self._state = 'disconnected'
             self.logger.error("Failed to connect: {}".format(e))
             return await self.reconnect(30);
 
@@ -83,16 +152,88 @@ class HyperDeck:
         await self.enable_notifications()
         await self.update_clips()
         await self.update_status()
+        await self.update_slots()
 
         return self._transport
 
+    def attach(self, reader, writer, poll=True, auto_refresh=True):
+        # Start talking to a HyperDeck over an already open stream pair. With
+        # auto_refresh off, slot notifications only update the slot cache and
+        # never send commands of their own.
+        self._loop = self._loop or asyncio.get_running_loop()
+        self._autoRefresh = auto_refresh
+        self.do_while = True
+        self._transport = (reader, writer)
+        self._state = 'connected'
+
+        # Set up a worker task to receive and parse responses from the
+        # Hyperdeck:
+        self._detach()
+        self._parser = self._create_task(self._parse_responses())
+
+        # Set up a worker task to periodically poll the HyperDeck state, so
+        # we can keep track of what it is currently doing. Only one poller
+        # runs at a time, starting afresh for each connection.
+        if poll:
+            self._pollWake = asyncio.Event()
+            self._poller = self._create_task(self._poll_state())
+
+    def _detach(self):
+        # Stop the worker tasks of the current connection before it is closed
+        # or replaced, so its parser doesn't take the close for the HyperDeck
+        # going away (and reconnect). The task doing the reconnecting is left
+        # to finish.
+        for task in (self._parser, self._poller):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self._parser = None
+        self._poller = None
+
     async def reconnect(self, reconnect_timer = None):
+        if self._closing:
+            return None
         if (reconnect_timer == None):
             reconnect_timer = 5 
         self.logger.error("Reconnecting in {} second(s)".format(reconnect_timer))
         await asyncio.sleep(reconnect_timer)
         return await self.connect()
 
+    async def close(self, timeout=5):
+        # Gracefully shut down the connection: refuse new commands, give the
+        # commands currently in flight a chance to receive their responses,
+        # then stop the worker tasks and close the socket.
+        self._closing = True
+
+        in_flight = [future for (future, _) in self._responses]
+        if in_flight:
+            done, pending = await asyncio.wait(in_flight, timeout=timeout)
+            if pending:
+                self.logger.warning(
+                    "Timed out waiting for {} in-flight command(s) to complete.".format(len(pending)))
+        self._fail_responses()
+
+        self.do_while = False
+
+        tasks = [task for task in self._tasks if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._transport:
+            try:
+                self._transport[1].close()
+                await self._transport[1].wait_closed()
+            except Exception as e:
+                self.logger.error("Failed to close current connection: {}".format(e))
+            self._transport = None
+
+        self._state = 'closed'
+        self.logger.info('Connection closed.')
+
+    async def raw_command(self, command):
+        # Send a raw protocol command, returning the parsed response.
+        return await self._send_command(command)
+
     async def ping(self):
         command = 'ping'
         response = await self._send_command(command)
@@ -104,15 +245,15 @@ class HyperDeck:
     async def record(self):
         command = 'record'
         response = await self._send_command(command)
-        if (response['error'] and response['error'] == True and self._callback is not None):
-            await self._callback('error', response);
+        if response and response['error']:
+            self.events.publish(EventBus.ERROR, response)
         return response and not response['error']
 
     async def record_named(self, clip_name):
         command = 'record: name: {}'.format(clip_name)
         response = await self._send_command(command)
-        if (response['error'] and response['error'] == True and self._callback is not None):
-            await self._callback('error', response);
+        if response and response['error']:
+            self.events.publish(EventBus.ERROR, response)
         return response and not response['error']
 
     async def play(self, single=True, loop=False, speed=1.0):
@@ -122,8 +263,8 @@ class HyperDeck:
         command = 'play:\nsingle clip: {}\nloop: {}\nspeed: {}\n\n'.format(
             single, loop, int(speed)).lower()
         response = await self._send_command(command)
-        if (response['error'] and response['error'] == True and self._callback is not None):
-            await self._callback('error', response);
+        if response and response['error']:
+            self.events.publish(EventBus.ERROR, response)
         return response and not response['error']
 
     async def stop(self):
@@ -150,15 +291,16 @@ class HyperDeck:
         return response and not response['error']
 
     async def slot_info(self, slot=None):
-        slotQuery = ''
-        if slot is None:
-            slotQuery = ''
-        elif slot <= 1:
-            slotQuery = ': slot id: 1';
-        elif slot >= 2:
-            slotQuery = ': slot id: 2';
+        slot = self._slot_id(slot)
+        slotQuery = '' if slot is None else ': slot id: {}'.format(slot)
         command = 'slot info{}'.format(slotQuery)
         response = await self._send_command(command)
+
+        if response and response['code'] == 202:
+            self._update_slot(response['lines'][1:])
+        elif response and response['code'] == 105 and slot is not None:
+            # 105 no disk
+            self._update_slot(['slot id: {}'.format(slot), 'status: empty', 'volume name: ', 'recording time: 0'])
         return response and not response['error']
 
     async def slot_select(self, slot=1):
@@ -170,22 +312,30 @@ class HyperDeck:
             slot = 2;
         command = 'slot select: slot id: {}'.format(slot)
         response = await self._send_command(command)
-        if (response['error'] and response['error'] == True and self._callback is not None):
-            await self._callback('error', response);
+        if response and response['error']:
+            self.events.publish(EventBus.ERROR, response)
         return response and not response['error']
 
     async def dist_list(self, slot=None):
-        slotQuery = ''
-        if slot is None:
-            slotQuery = ''
-        elif slot <= 1:
-            slotQuery = ': slot id: 1';
-        elif slot >= 2:
-            slotQuery = ': slot id: 2';
+        slot = self._slot_id(slot)
+        slotQuery = '' if slot is None else ': slot id: {}'.format(slot)
         command = 'disk list{}'.format(slotQuery)
         response = await self._send_command(command)
+
+        if response and response['code'] == 206:
+            self._update_disks(response['lines'][1:])
+        elif response and response['code'] == 105 and slot is not None:
+            self._update_disks(['slot id: {}'.format(slot)])
         return response and not response['error']
 
+    async def update_slots(self):
+        # Refresh the inventory of every slot, with all of the queries
+        # pipelined down the connection together.
+        queries = []
+        for slot in slot_ids:
+            queries.append(asyncio.ensure_future(self.slot_info(slot)))
+            queries.append(asyncio.ensure_future(self.dist_list(slot)))
+        await asyncio.gather(*queries)
 
     async def update_clips(self):
         command = 'clips get'
@@ -215,12 +365,11 @@ class HyperDeck:
 
                 self.clips.append(clip)
 
-        if self._callback is not None:
-            await self._callback('clips')
+        self.events.publish(EventBus.CLIPS, self.clips)
 
-    async def update_status(self):
+    async def update_status(self, transcript=True):
         command = 'transport info'
-        response = await self._send_command(command)
+        response = await self._send_command(command, transcript=transcript)
 
         self.status = dict()
 
@@ -233,53 +382,192 @@ class HyperDeck:
                 (name, value) = line.split(': ', 1)
                 self.status[name] = value
 
-        if self._callback is not None:
-            await self._callback('status')
+        self.events.publish(EventBus.STATUS, self.status)
+        return response is not None and response['code'] == 208
 
     async def enable_notifications(self, slot=True, remote=True, config=True):
         command = 'notify:\nslot: {}\nremote: {}\nconfiguration: {}\n\n'.format(
             slot, remote, config).lower()
         response = await self._send_command(command)
-        return not response['error']
+        return response and not response['error']
 
-    async def _send_command(self, command):
-        if not self._transport:
+    async def _send_command(self, command, transcript=True):
+        if not self._transport or self._closing:
             return None
 
-        # We need to wait here if another command is currently in progress,
-        # as the HyperDeck processes all commands and gives all response in
-        # sequence.
-        if self._response_future:
-            await self._response_future
-
-        # Set up a future to receive the response from the HyperDeck, and send
-        # the command.
-        self._response_future = asyncio.Future(loop=self._loop)
+        # The HyperDeck processes all commands and gives all responses in
+        # sequence, so commands are pipelined: each one is written straight
+        # away and queues a future that is resolved by the matching response,
+        # in the order they were sent. Nothing may be awaited between queuing
+        # the future and writing the command, or the order would be lost.
+        timing = request_timing.get()
+        queued = time.perf_counter()
+        ahead = len(self._responses)
+
+        response_future = self._loop.create_future()
+        self._responses.append((response_future, time.monotonic()))
         await self._send(command)
-        response = await self._response_future
+        written = time.perf_counter()
+        response = await response_future
+
+        if timing is not None:
+            timing['commands'].append({
+                'command': command.split('\n', 1)[0],
+                'ahead': ahead,
+                'queued': queued,
+                'written': written,
+                'ack': time.perf_counter(),
+            })
+
+        # The connection was lost before the HyperDeck responded.
+        if response is None:
+            return None
 
-        if self._callback is not None:
-            transcript = {
+        if transcript:
+            self.events.publish(EventBus.TRANSCRIPT, {
                 'sent': command.split('\n'),
                 'received': response['lines']
-            }
-            await self._callback('transcript', transcript)
+            })
 
         return response
 
+    def _fail_responses(self):
+        # Release every command still waiting for a response, they will never
+        # get one on this connection.
+        while self._responses:
+            (response_future, _) = self._responses.popleft()
+            if not response_future.done():
+                response_future.set_result(None)
+
+    def _slot_id(self, slot):
+        # The HyperDeck has two slots, out of range ids select the nearest.
+        if slot is None:
+            return None
+        return min(max(slot, slot_ids[0]), slot_ids[-1])
+
+    def _slot(self, slot_id):
+        # The cached inventory of a slot, created empty on first use.
+        if slot_id not in self.slots:
+            self.slots[slot_id] = {
+                'slot id': slot_id,
+                'status': 'empty',
+                'volume name': '',
+                'recording time': 0,
+                'video format': '',
+                'disks': [],
+            }
+        return self.slots[slot_id]
+
+    def _update_slot(self, lines):
+        # Cache the properties of a slot info response (or 502 notification),
+        # one per line starting with the slot id. Notifications may only carry
+        # the properties that changed. Returns the slot's cached inventory,
+        # and whether its media has changed.
+        info = dict()
+        for line in lines:
+            if ': ' in line:
+                (name, value) = line.split(': ', 1)
+                info[name] = value
+        if 'slot id' not in info:
+            return (None, True)
+
+        slot = self._slot(info.pop('slot id'))
+        media = (slot['status'], slot['volume name'])
+        if 'recording time' in info:
+            try:
+                info['recording time'] = int(info['recording time'])
+            except ValueError:
+                info['recording time'] = 0
+        slot.update(info)
+        if slot['status'] != 'mounted':
+            slot['disks'] = []
+
+        self.events.publish(EventBus.SLOTS, self.slots)
+        return (slot, media != (slot['status'], slot['volume name']))
+
+    def _update_disks(self, lines):
+        # Cache a disk list response: the slot id, followed by one line per
+        # clip on the disk holding its id, name, codec, video format and
+        # duration.
+        if len(lines) == 0 or not lines[0].startswith('slot id: '):
+            return
+        slot = self._slot(lines[0].split(': ', 1)[1])
+
+        slot['disks'] = []
+        for line in lines[1:]:
+            if ': ' not in line:
+                continue
+            (disk_id, info) = line.split(': ', 1)
+            fields = info.split(' ')
+            if len(fields) < 4:
+                continue
+            slot['disks'].append({
+                'id': disk_id,
+                'name': ' '.join(fields[0: len(fields) - 3]),
+                'codec': fields[-3],
+                'format': fields[-2],
+                'duration': fields[-1],
+            })
+
+        self.events.publish(EventBus.SLOTS, self.slots)
+
+    async def _refresh_slot(self, slot_id):
+        # Short delay to give the HyperDeck enough time to update its
+        # internal clip state.
+        await asyncio.sleep(1)
+
+        if slot_id is not None:
+            await self.dist_list(int(slot_id))
+        await self.update_clips()
+
+    def _poll_interval(self, failures):
+        # We have to periodically poll the HyperDeck's state, rather than
+        # bombarding it with continuous updates. Poll quickly while it is
+        # doing something worth watching, slowly while it sits idle, and back
+        # off while it isn't answering.
+        if failures > 0:
+            return min(slow_poll_interval * (2 ** failures), max_poll_backoff)
+        if self._socketCount <= 0:
+            return idle_poll_interval
+        if self.status.get('status', None) in active_states:
+            return fast_poll_interval
+        return slow_poll_interval
+
     async def _poll_state(self):
+        failures = 0
         while self.do_while:
             try:
-                # We have to periodically poll the HyperDeck's state, rather than
-                # bombarding it with continuous updates.
-                await asyncio.sleep(1)
-
-                # Only send a new update if we have at least one socket connected or its been an hour
-                if self._socketCount > 0 or self._statusCount >= status_timeout:
-                    self._statusCount = 0
-                    await self.update_status()
+                self._pollWake.clear()
+                try:
+                    await asyncio.wait_for(self._pollWake.wait(), self._poll_interval(failures))
+                except asyncio.TimeoutError:
+                    pass
+
+                # Don't queue a poll behind commands the HyperDeck still owes
+                # us responses for. If the oldest has waited longer than a
+                # poll may (e.g. an earlier poll that timed out), the deck is
+                # not answering and we back off as for a missed poll.
+                if self._responses:
+                    if time.monotonic() - self._responses[0][1] < poll_timeout:
+                        continue
+                    answered = False
+                else:
+                    # Polls are not shown in the transcript, they would drown
+                    # out the commands sent by the user.
+                    try:
+                        answered = await asyncio.wait_for(self.update_status(transcript=False), poll_timeout)
+                    except asyncio.TimeoutError:
+                        answered = False
+
+                if answered:
+                    failures = 0
                 else:
-                    self._statusCount = self._statusCount + 1;
+                    failures += 1
+                    self.logger.warning(
+                        "HyperDeck is not answering, checking again in {} second(s).".format(
+                            self._poll_interval(failures)))
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 self.logger.error(
                     "_poll_state failed: {}".format(e))
@@ -296,11 +584,16 @@ class HyperDeck:
                     continue
             except Exception as e:
                 self.do_while = False
+                self._state = 'disconnected'
+                self._fail_responses()
                 self.logger.error(
                     "Connection failed: {}".format(e))
                 await self.reconnect();
                 return
 
+            # Any response at all means the HyperDeck is alive and answering.
+            self._lastResponseTime = time.monotonic()
+
             try:
                 # Response code is the first number in the first response line
                 # from the HyperDeck. Abort if we receive a malformed response.
@@ -317,41 +610,53 @@ class HyperDeck:
             is_async_response = response_code >= 500 and response_code < 600
 
             # The 502 response code indicates a slot information change; a disk/card
-            # has been inserted or removed.
+            # has been inserted or removed, or the remaining recording time
+            # has changed. The notification carries the new slot info, so the
+            # slot's cache is updated straight from it.
             if response_code == 502:
-                # Short delay to give the HyperDeck enough time to update its
-                # internal clip state.
-                await asyncio.sleep(1)
+                (slot, changed) = self._update_slot(response_lines[1:])
 
-                # 502 Slot Info responses require us to refresh our local clip
-                # cache, since the available disk(s) have changed. Run this
-                # on the event loop outside this function, so we don't deadlock.
-                self._loop.create_task(self.update_clips())
+                # Only a change of media requires us to refresh the slot's
+                # disk list and our local clip cache. Run this on the event
+                # loop outside this function, so we don't deadlock.
+                if changed and self._autoRefresh:
+                    self._create_task(self._refresh_slot(None if slot is None else slot['slot id']))
 
             # Only signal the completion of a command that is in progress, if
             # this is not an asynchronous response.
-            if not is_async_response and self._response_future is not None:
+            if not is_async_response and self._responses:
                 response = {
                     'error': is_error_response,
                     'code': response_code,
                     'lines': response_lines,
                 }
 
-                self._response_future.set_result(response)
-                self._response_future = None
+                (response_future, _) = self._responses.popleft()
+                if not response_future.done():
+                    response_future.set_result(response)
 
     async def _send(self, data):
         self.logger.debug('Sent: {}'.format([data]))
 
         data += '\r\n'
-        return self._transport[1].write(data.encode('utf-8'))
+        payload = data.encode('utf-8')
+        if self._trace is not None:
+            self._trace.write(Trace.SENT, payload)
+        return self._transport[1].write(payload)
 
     async def _receive(self):
         if not self._transport:
             return
 
+        raw = []
+
         async def _read_line():
             line = await self._transport[0].readline()
+            # An empty read (not even a line ending) means the HyperDeck
+            # closed the connection.
+            if not line:
+                raise ConnectionError("Connection closed by the HyperDeck")
+            raw.append(line)
             return bytes(line).decode('utf-8').rstrip()
 
         lines = []
@@ -370,5 +675,8 @@ class HyperDeck:
 
                 lines.append(line)
 
+        if self._trace is not None:
+            self._trace.write(Trace.RECEIVED, b''.join(raw))
+
         self.logger.debug('Received: {}'.format(lines))
         return lines
@@ -0,0 +1,20 @@
+import json
+
+# JSON for websocket messages and the deck owner channel, using orjson when it
+# is installed, otherwise a single shared standard library decoder and
+# encoder. decode() accepts str or bytes; encode() returns str and
+# encode_bytes() returns UTF-8 bytes.
+try:
+    import orjson
+
+    decode = orjson.loads
+    encode_bytes = orjson.dumps
+
+    def encode(message):
+        return orjson.dumps(message).decode('utf-8')
+except ImportError:
+    decode = json.JSONDecoder().decode
+    encode = json.JSONEncoder().encode
+
+    def encode_bytes(message):
+        return encode(message).encode('utf-8')
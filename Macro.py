@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import math
+import time
+
+import Commands
+
+# Longest batch accepted in one request.
+max_steps = 64
+
+# Default and maximum time a wait step will wait for its status condition,
+# and how often the HyperDeck status is refreshed while waiting.
+wait_timeout = 5
+max_wait_timeout = 60
+wait_interval = 0.25
+
+# Longest a delay step will pause for (in seconds).
+max_delay = 60
+
+# Longest a whole batch may run for (in seconds). Steps still to run when it
+# is up fail.
+max_duration = 120
+
+
+def seconds(value, maximum, name):
+    # A step's time in seconds, which must be a finite number. It is capped
+    # at the maximum.
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("{} must be a finite number of seconds".format(name))
+    return min(max(value, 0), maximum)
+
+
+class MacroEngine:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, hyperdeck):
+        self._hyperdeck = hyperdeck
+
+    def validate(self, steps):
+        # Check the whole batch up front, so a malformed step fails the batch
+        # before any command is sent to the HyperDeck. Returns the steps with
+        # their command params parsed.
+        if not isinstance(steps, list) or len(steps) == 0:
+            raise ValueError("batch steps must be a non-empty list")
+        if len(steps) > max_steps:
+            raise ValueError("batch has {} steps, the maximum is {}".format(len(steps), max_steps))
+
+        parsed = []
+        for index, step in enumerate(steps):
+            if not isinstance(step, dict):
+                raise ValueError("step {} must be an object".format(index))
+            if 'command' in step:
+                if step['command'] not in Commands.actions:
+                    raise ValueError("step {}: unknown command '{}'".format(index, step['command']))
+                (_, parse) = Commands.actions[step['command']]
+                try:
+                    step = dict(step, params=parse(step.get('params', None)))
+                except ValueError as e:
+                    raise ValueError("step {}: {}".format(index, e))
+            elif 'wait' in step:
+                if not isinstance(step['wait'], dict) or len(step['wait']) == 0:
+                    raise ValueError("step {}: wait must be a non-empty object of status values".format(index))
+                try:
+                    step = dict(step, timeout=seconds(step.get('timeout', wait_timeout), max_wait_timeout, 'timeout'))
+                except (TypeError, ValueError) as e:
+                    raise ValueError("step {}: {}".format(index, e))
+            elif 'delay' in step:
+                try:
+                    step = dict(step, delay=seconds(step['delay'], max_delay, 'delay'))
+                except (TypeError, ValueError) as e:
+                    raise ValueError("step {}: {}".format(index, e))
+            else:
+                raise ValueError("step {} needs one of 'command', 'wait' or 'delay'".format(index))
+            parsed.append(step)
+
+        return parsed
+
+    async def run(self, steps, stop_on_error=True):
+        # Runs the batch, returning one result per step. Without stop_on_error
+        # consecutive command steps are pipelined down the control connection
+        # together; wait and delay steps act as barriers between them. With
+        # stop_on_error each command waits for the previous one to be
+        # acknowledged, so nothing is sent after a rejected command.
+        steps = self.validate(steps)
+
+        results = [None] * len(steps)
+        failed = False
+        index = 0
+        deadline = time.monotonic() + max_duration
+
+        while index < len(steps):
+            if failed and stop_on_error:
+                results[index] = self._result(steps[index], 'skipped')
+                index += 1
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                results[index] = self._result(
+                    steps[index], 'error', "Batch ran over its {} second limit".format(max_duration))
+                failed = True
+                index += 1
+                continue
+
+            if 'command' in steps[index]:
+                group = []
+                while index < len(steps) and 'command' in steps[index] and not (stop_on_error and group):
+                    group.append(index)
+                    index += 1
+
+                # Start every command of the group in order; each is written
+                # to the HyperDeck before the next one starts.
+                tasks = [asyncio.ensure_future(self._run_command(steps[i])) for i in group]
+                for i, result in zip(group, await asyncio.gather(*tasks)):
+                    results[i] = result
+                    failed = failed or result['status'] != 'ok'
+            else:
+                step = steps[index]
+                if 'wait' in step:
+                    results[index] = await self._run_wait(step, min(step['timeout'], remaining))
+                elif step['delay'] > remaining:
+                    await asyncio.sleep(remaining)
+                    results[index] = self._result(
+                        step, 'error', "Batch ran over its {} second limit".format(max_duration))
+                else:
+                    await asyncio.sleep(step['delay'])
+                    results[index] = self._result(step, 'ok')
+                failed = failed or results[index]['status'] != 'ok'
+                index += 1
+
+        return results
+
+    async def _run_command(self, step):
+        command = step['command']
+        start = time.monotonic()
+        (action, _) = Commands.actions[command]
+        try:
+            accepted = await action(self._hyperdeck, step['params'])
+        except Exception as e:
+            return self._result(step, 'error', "{}".format(e), start)
+
+        if command in Commands.refresh_actions or accepted:
+            return self._result(step, 'ok', start=start)
+        return self._result(step, 'error', "HyperDeck rejected '{}'".format(command), start)
+
+    async def _run_wait(self, step, timeout):
+        condition = step['wait']
+        start = time.monotonic()
+
+        while True:
+            await self._hyperdeck.update_status()
+            if self._matches(condition, self._hyperdeck.status):
+                return self._result(step, 'ok', start=start)
+            if time.monotonic() - start >= timeout:
+                return self._result(step, 'error', "Timed out waiting for {}".format(condition), start)
+            await asyncio.sleep(wait_interval)
+
+    def _matches(self, condition, status):
+        # Every named status field must equal the given value, or one of the
+        # given values when a list is passed.
+        for name, expected in condition.items():
+            values = expected if isinstance(expected, list) else [expected]
+            if "{}".format(status.get(name, '')).lower() not in ["{}".format(value).lower() for value in values]:
+                return False
+        return True
+
+    def _result(self, step, status, message=None, start=None):
+        result = {
+            'step': step.get('command') or ('wait' if 'wait' in step else 'delay'),
+            'status': status,
+        }
+        if message is not None:
+            result['message'] = message
+        if start is not None:
+            result['elapsed'] = round(time.monotonic() - start, 4)
+        return result
@@ -1,31 +1,247 @@
 #!/usr/bin/env python3
 
+import time
+_start_time = time.perf_counter()
+
 import asyncio
 import logging
 import argparse
+import os
+import signal
+import socket
+import sys
+import tempfile
 
-import WebUI
 import HyperDeck
+import EventBus
+import Trace
+
+
+def install_event_loop(engine):
+    # Select the event loop implementation. uvloop is an optional drop-in
+    # replacement with lower per-I/O overhead; fall back to the default
+    # asyncio loop if it is not installed.
+    if engine != 'uvloop':
+        return 'asyncio'
+
+    try:
+        import uvloop
+    except ImportError:
+        print("The uvloop library was not found. Install it via `pip3 install uvloop` to use it, falling back to asyncio.")
+        return 'asyncio'
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+
+def install_signal_handlers(stop_event):
+    # Request a graceful shutdown on SIGINT/SIGTERM.
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows event loops do not support add_signal_handler.
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop_event.set))
+
+
+def elapsed():
+    return (time.perf_counter() - _start_time) * 1000
+
+
+async def run_until_stopped(stop_event, startup, shutdown):
+    # Start up in the background, so a shutdown request is honoured at any
+    # point, then wait for one. A failed start up shuts down as well, and
+    # returns False.
+    logger = logging.getLogger('Main')
+    startup_task = asyncio.ensure_future(startup())
+
+    def startup_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Start up failed: {}".format(task.exception()))
+            stop_event.set()
+
+    startup_task.add_done_callback(startup_done)
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Shutting down...")
+        startup_task.cancel()
+        await asyncio.gather(startup_task, return_exceptions=True)
+
+        shutdown_start = time.perf_counter()
+        await shutdown()
+        logger.info("Shutdown completed in {:.1f} ms.".format(
+            (time.perf_counter() - shutdown_start) * 1000))
+
+    return startup_task.cancelled() or startup_task.exception() is None
+
+
+async def start_web_ui(args, hyperdeck, reuse_port=False):
+    logger = logging.getLogger('Main')
+
+    # Bind the web UI port before loading the (slow to import) web stack,
+    # connections made in the meantime wait in the socket backlog.
+    sock = socket.create_server((args.address, args.port), backlog=128, reuse_port=reuse_port)
+    logger.info("Listening on {}:{} after {:.1f} ms.".format(args.address, args.port, elapsed()))
+
+    import WebUI
+    webui = WebUI.WebUI(address=args.address, port=args.port, key=args.key, session=args.session,
+                        status_rate=args.statusRate)
+    await webui.start(hyperdeck, sock=sock)
+    logger.info("Web UI ready after {:.1f} ms using the {} event loop.".format(elapsed(), args.engine))
+    return webui
+
+
+def create_hyperdeck(args, events):
+    logger = logging.getLogger('Main')
+    trace = None
+    if args.trace:
+        trace = Trace.TraceWriter(args.trace)
+        logger.info("Capturing HyperDeck protocol trace to {}".format(args.trace))
+    return (HyperDeck.HyperDeck(host=args.hyperdeckIP, port=args.hyperdeckPort, events=events, trace=trace), trace)
+
+
+async def connect_hyperdeck(hyperdeck):
+    # Connect to the HyperDeck in the background of the running web UI,
+    # this retries until the deck is reachable.
+    if await hyperdeck.connect():
+        logging.getLogger('Main').info("HyperDeck connected after {:.1f} ms.".format(elapsed()))
+
+
+async def run_single(args, stop_event):
+    # The web UI and the HyperDeck connection share this process.
+    events = EventBus.EventBus()
+    (hyperdeck, trace) = create_hyperdeck(args, events)
+    webui = None
+
+    async def startup():
+        nonlocal webui
+        webui = await start_web_ui(args, hyperdeck)
+        await connect_hyperdeck(hyperdeck)
+
+    async def shutdown():
+        if webui is not None:
+            await webui.stop()
+        await hyperdeck.close()
+        events.close()
+        if trace is not None:
+            trace.close()
+
+    return await run_until_stopped(stop_event, startup, shutdown)
+
+
+async def supervise_web_worker(args, index):
+    # Run a web worker process, restarting it if it exits unexpectedly.
+    logger = logging.getLogger('Main')
+    command = [
+        sys.executable, os.path.abspath(__file__), '--worker', '--ipc={}'.format(args.ipc),
+        '--address={}'.format(args.address), '--port={}'.format(args.port),
+        '--key={}'.format(args.key), '--session={}'.format(args.session),
+        '--engine={}'.format(args.engine), '--statusRate={}'.format(args.statusRate),
+        '--logLevel={}'.format(args.logLevel),
+    ]
+
+    while True:
+        process = await asyncio.create_subprocess_exec(*command)
+        logger.info("Started web worker {} (pid {}).".format(index, process.pid))
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), 5)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+            raise
+
+        logger.warning("Web worker {} exited with code {}, restarting.".format(index, code))
+        await asyncio.sleep(1)
+
+
+async def run_deck_owner(args, stop_event):
+    # This process owns the HyperDeck connection and serves its state to the
+    # web worker processes, which share the web UI port between them.
+    import Sharding
+
+    events = EventBus.EventBus()
+    (hyperdeck, trace) = create_hyperdeck(args, events)
+    server = Sharding.DeckServer(hyperdeck, args.ipc)
+    workers = []
+
+    async def startup():
+        await server.start()
+        for index in range(args.workers):
+            workers.append(asyncio.ensure_future(supervise_web_worker(args, index)))
+        await connect_hyperdeck(hyperdeck)
+
+    async def shutdown():
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await server.stop()
+        await hyperdeck.close()
+        events.close()
+        if trace is not None:
+            trace.close()
+
+    return await run_until_stopped(stop_event, startup, shutdown)
+
+
+async def run_web_worker(args, stop_event):
+    # A web worker serves the web UI, mirroring the HyperDeck state from the
+    # deck owner process and forwarding commands to it.
+    import Sharding
+
+    hyperdeck = Sharding.RemoteHyperDeck(args.ipc)
+    webui = None
+
+    async def startup():
+        nonlocal webui
+        webui = await start_web_ui(args, hyperdeck, reuse_port=True)
+        await hyperdeck.connect()
+
+        # Exit along with the deck owner.
+        await hyperdeck.wait_closed()
+        stop_event.set()
+
+    async def shutdown():
+        if webui is not None:
+            await webui.stop()
+        await hyperdeck.close()
+        hyperdeck.events.close()
+
+    return await run_until_stopped(stop_event, startup, shutdown)
 
 
-async def main(loop, args):
+async def main(args):
     logging.basicConfig(
         format='(%(asctime)s) [%(levelname)s] %(name)s: %(message)s', datefmt='%m-%d-%Y %H:%M:%S', level=args.logLevel)
     # Configure log level for the various modules.
     loggers = {
+        'Main': args.logLevel,
         'WebUI': args.logLevel,
         'HyperDeck': args.logLevel,
+        'EventBus': args.logLevel,
+        'Sharding': args.logLevel,
         'aiohttp': logging.ERROR,
     }
     for name, level in loggers.items():
         logger = logging.getLogger(name)
         logger.setLevel(level)
 
-    hyperdeck = HyperDeck.HyperDeck(host=args.hyperdeckIP, port=args.hyperdeckPort)
-    await hyperdeck.connect()
+    stop_event = asyncio.Event()
+    install_signal_handlers(stop_event)
 
-    webui = WebUI.WebUI(address=args.address, port=args.port, key=args.key, session=args.session)
-    await webui.start(hyperdeck)
+    if args.worker:
+        started = await run_web_worker(args, stop_event)
+    elif args.workers > 0:
+        started = await run_deck_owner(args, stop_event)
+    else:
+        started = await run_single(args, stop_event)
+    return 0 if started else 1
 
 if __name__ == "__main__":
     # Parse command line arguments
@@ -42,9 +258,20 @@ if __name__ == "__main__":
                         default='=-0JdLGhHOrA1iKD5dvyw9hhmgH5aXKJIRlqy0PMAIv4=', help='The session cookie name for login storage, default: HYPER_UI_SESSION')
     parser.add_argument('-s', '--session', type=str, nargs='?',
                         default='HYPER_UI_SESSION', help='The session cookie name for login storage, default: HYPER_UI_SESSION')
+    parser.add_argument('-e', '--engine', type=str, nargs='?', choices=['asyncio', 'uvloop'],
+                        default='asyncio', help='The event loop implementation to use, default: asyncio')
+    parser.add_argument('-t', '--trace', type=str, nargs='?', default=None,
+                        help='Append a timestamped trace of the HyperDeck protocol to this file, for use with Replay.py, default: off')
+    parser.add_argument('-r', '--statusRate', type=float, nargs='?', default=10,
+                        help='The most status updates sent to each browser per second, 0 sends every update, default: 10')
+    parser.add_argument('-w', '--workers', type=int, nargs='?', default=0,
+                        help='Serve the web UI from this many worker processes sharing the port, with the HyperDeck connection in a separate process (Linux/macOS only), default: 0 (single process)')
+    parser.add_argument('--ipc', type=str, nargs='?', default=None,
+                        help='The Unix socket the deck owner and web workers communicate over, default: hyperdeck-ui-<port>.sock in the temp directory')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
     parser.add_argument('-log', '--logLevel', type=int, nargs='?',
                         default=20, help='''The Loggers base level anything above it will also be shown.
-                                            Levels:  
+                                            Levels:
                                                 (None) 0
                                                 (DEBUG) 10
                                                 (Info) 20
@@ -53,9 +280,11 @@ if __name__ == "__main__":
                                                 (CRITICAL) 50
                                             Default: 20''')
 
-args = parser.parse_args()
+    args = parser.parse_args()
+    if args.ipc is None:
+        args.ipc = os.path.join(tempfile.gettempdir(), 'hyperdeck-ui-{}.sock'.format(args.port))
+    args.engine = install_event_loop(args.engine)
 
-# Run the application with the user arguments
-loop = asyncio.get_event_loop()
-loop.run_until_complete(main(loop, args))
-loop.run_forever()
+    # Run the application with the user arguments, exiting non-zero if it
+    # failed to start
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import argparse
+import time
+
+import EventBus
+import HyperDeck
+import Trace
+
+
+class NullWriter:
+    # Stands in for the HyperDeck socket while replaying, commands are
+    # "sent" nowhere since their responses come from the trace.
+    def __init__(self):
+        self._closed = False
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+def command_slot(command):
+    # The slot a slot query was sent for, e.g. 2 for 'slot info: slot id: 2'.
+    if 'slot id: ' not in command:
+        return None
+    return int(command.rsplit('slot id: ', 1)[1])
+
+
+async def replay_command(hyperdeck, command):
+    # Commands the HyperDeck uses to refresh its caches go through the same
+    # methods as they did live, so the status, clip and slot events are
+    # published to the web UI again.
+    if command == 'transport info':
+        await hyperdeck.update_status()
+    elif command == 'clips get':
+        await hyperdeck.update_clips()
+    elif command.startswith('slot info'):
+        await hyperdeck.slot_info(command_slot(command))
+    elif command.startswith('disk list'):
+        await hyperdeck.dist_list(command_slot(command))
+    else:
+        await hyperdeck.raw_command(command)
+
+
+async def main(args):
+    logging.basicConfig(
+        format='(%(asctime)s) [%(levelname)s] %(name)s: %(message)s', datefmt='%m-%d-%Y %H:%M:%S', level=args.logLevel)
+    for name in ('Replay', 'WebUI', 'HyperDeck', 'EventBus'):
+        logging.getLogger(name).setLevel(args.logLevel)
+    logging.getLogger('aiohttp').setLevel(logging.ERROR)
+    logger = logging.getLogger('Replay')
+
+    # Feed the recorded responses straight into the HyperDeck's parser, in
+    # place of a real connection. The refreshes the parser started live are
+    # in the trace already, so it mustn't start its own.
+    events = EventBus.EventBus()
+    hyperdeck = HyperDeck.HyperDeck(host='replay', port=0, events=events)
+    reader = asyncio.StreamReader()
+    hyperdeck.attach(reader, NullWriter(), poll=False, auto_refresh=False)
+
+    import WebUI
+    webui = WebUI.WebUI(address=args.address, port=args.port)
+    await webui.start(hyperdeck)
+    if args.wait > 0:
+        logger.info("Waiting {} second(s) for viewers to connect...".format(args.wait))
+        await asyncio.sleep(args.wait)
+
+    logger.info("Replaying {} at {}".format(
+        args.trace, "full speed" if args.speed <= 0 else "{}x speed".format(args.speed)))
+
+    commands = []
+    frames = 0
+    first = None
+    start = time.perf_counter()
+    for (timestamp, direction, payload) in Trace.TraceReader(args.trace):
+        if first is None:
+            first = timestamp
+
+        # Keep to the recorded timing, scaled by the replay speed.
+        if args.speed > 0:
+            delay = (timestamp - first) / args.speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        if direction == Trace.SENT:
+            command = payload.decode('utf-8')
+            if command.endswith('\r\n'):
+                command = command[:-2]
+            commands.append(asyncio.ensure_future(replay_command(hyperdeck, command)))
+        else:
+            reader.feed_data(payload)
+
+        # Let the parser and web UI catch up with this frame.
+        await asyncio.sleep(0)
+        frames += 1
+
+    if commands:
+        done, pending = await asyncio.wait(commands, timeout=5)
+        if pending:
+            logger.warning("{} command(s) had no recorded response.".format(len(pending)))
+    elapsed = time.perf_counter() - start
+
+    logger.info("Replayed {} frame(s) covering {:.3f} s of recording in {:.3f} s ({:.0f} frames/s).".format(
+        frames, (timestamp - first) if frames else 0, elapsed, frames / elapsed if elapsed > 0 else 0))
+
+    await webui.stop()
+    await hyperdeck.close(timeout=0)
+    events.close()
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Replay a HyperDeck protocol trace captured with `Main.py --trace` through the parser and web UI.')
+    parser.add_argument('trace', type=str,
+                        help='The trace file to replay')
+    parser.add_argument('-x', '--speed', type=float, nargs='?', default=1.0,
+                        help='Replay speed relative to the recording, 0 replays as fast as possible, default: 1.0')
+    parser.add_argument('-a', '--address', type=str, nargs='?', default='localhost',
+                        help='The host to use for the web UI, default: localhost')
+    parser.add_argument('-p', '--port', type=int, nargs='?', default=8080,
+                        help="The port to use for the web UI, default: 8080")
+    parser.add_argument('-w', '--wait', type=float, nargs='?', default=0,
+                        help='Seconds to wait for web UI viewers to connect before replaying, default: 0')
+    parser.add_argument('-log', '--logLevel', type=int, nargs='?',
+                        default=20, help='The Loggers base level anything above it will also be shown, default: 20')
+
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,373 @@
+import asyncio
+import logging
+import os
+
+import EventBus
+import HyperDeck
+import Json
+
+# Messages between the deck owner and web worker processes are JSON, one per
+# line.
+
+# Largest single message on the channel (a long clip list can be sizeable).
+message_limit = 16 * 1024 * 1024
+
+# How often the deck owner pushes its cached health to the web workers.
+health_interval = 1.0
+
+# HyperDeck methods the web workers may call on the deck owner.
+remote_methods = frozenset([
+    'record', 'record_named', 'play', 'stop', 'select_clip_by_index',
+    'select_clip_by_offset', 'jog_to_timecode', 'slot_info', 'slot_select',
+    'dist_list', 'update_clips', 'update_status', 'update_slots', 'setNetwork',
+])
+
+# Methods that refresh a cache return the refreshed cache to the caller, so
+# it is up to date as soon as the call returns (their events may arrive a
+# little later).
+cache_results = {
+    'update_status': lambda hyperdeck: hyperdeck.status,
+    'update_clips': lambda hyperdeck: hyperdeck.clips,
+    'update_slots': lambda hyperdeck: hyperdeck.slots,
+}
+
+
+def write_message(writer, message):
+    writer.write(Json.encode_bytes(message) + b'\n')
+
+
+class DeckServer:
+    # Runs in the deck owner process, which holds the HyperDeck connection.
+    # Web workers connect over a Unix socket to receive every HyperDeck event
+    # and to forward the commands of their websocket clients.
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, hyperdeck, path):
+        self.path = path
+
+        self._hyperdeck = hyperdeck
+        self._server = None
+        self._health_task = None
+        self._workers = dict()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(
+            self._handle_worker, path=self.path, limit=message_limit)
+        self._health_task = asyncio.ensure_future(self._push_health())
+        self.logger.info("Serving web workers on {}".format(self.path))
+
+    async def stop(self):
+        if self._server is None:
+            return
+
+        self._health_task.cancel()
+        self._server.close()
+        for writer in list(self._workers):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _snapshot(self):
+        return {
+            'clips': self._hyperdeck.clips,
+            'status': self._hyperdeck.status,
+            'slots': self._hyperdeck.slots,
+            'health': self._hyperdeck.health(),
+        }
+
+    def _update_socket_count(self):
+        # The HyperDeck polls faster while anyone is watching, across all
+        # of the workers.
+        self._hyperdeck.connectedSockets(sum(self._workers.values()))
+
+    async def _push_health(self):
+        while True:
+            await asyncio.sleep(health_interval)
+            message = {'health': self._hyperdeck.health()}
+            for writer in list(self._workers):
+                write_message(writer, message)
+
+    async def _handle_worker(self, reader, writer):
+        self._workers[writer] = 0
+        events = self._hyperdeck.events.subscribe()
+        forward = asyncio.ensure_future(self._forward_events(events, writer))
+        calls = set()
+        self.logger.info("({}) Web worker connected.".format(len(self._workers)))
+
+        try:
+            write_message(writer, {'snapshot': self._snapshot()})
+
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                message = Json.decode(line)
+                if 'call' in message:
+                    # Start each call straight away, in the order received, so
+                    # the worker's commands are pipelined to the HyperDeck in
+                    # the same order.
+                    task = asyncio.ensure_future(self._call(message, writer))
+                    calls.add(task)
+                    task.add_done_callback(calls.discard)
+                elif 'sockets' in message:
+                    self._workers[writer] = int(message['sockets'])
+                    self._update_socket_count()
+        except Exception as e:
+            self.logger.error("Web worker connection failed: {}".format(e))
+        finally:
+            events.close()
+            forward.cancel()
+            for task in calls:
+                task.cancel()
+            del self._workers[writer]
+            self._update_socket_count()
+            writer.close()
+            self.logger.info("({}) Web worker disconnected.".format(len(self._workers)))
+
+    async def _forward_events(self, events, writer):
+        # Events are taken from this worker's own bounded queue, so a worker
+        # that can't keep up never holds up the HyperDeck. If the queue had
+        # to drop events, the worker's mirrored state may have missed a
+        # change, so a fresh snapshot is sent first.
+        dropped = events.dropped
+        async for event in events:
+            if events.dropped != dropped:
+                dropped = events.dropped
+                self.logger.warning("Web worker fell behind, resending a snapshot.")
+                write_message(writer, {'snapshot': self._snapshot()})
+            write_message(writer, {'event': event.type, 'params': event.params})
+            await writer.drain()
+
+    async def _call(self, message, writer):
+        method = message.get('method', None)
+        reply = {'reply': message['call']}
+
+        timing = {'commands': []} if message.get('timed', False) else None
+        token = HyperDeck.request_timing.set(timing)
+        try:
+            if method not in remote_methods:
+                raise ValueError("Unknown HyperDeck method '{}'".format(method))
+            result = await getattr(self._hyperdeck, method)(*message.get('args', []))
+            if method in cache_results:
+                result = cache_results[method](self._hyperdeck)
+            reply['result'] = result
+        except Exception as e:
+            reply['error'] = "{}".format(e)
+        finally:
+            HyperDeck.request_timing.reset(token)
+
+        if timing is not None:
+            reply['commands'] = timing['commands']
+        write_message(writer, reply)
+
+
+class RemoteHyperDeck:
+    # Stands in for the HyperDeck inside a web worker process. State is
+    # mirrored from the events the deck owner pushes, and commands are
+    # forwarded to it.
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, path, events=None):
+        self.path = path
+        self.clips = []
+        self.status = dict()
+        self.slots = dict()
+        self.events = events or EventBus.EventBus()
+
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._closed = None
+        self._calls = dict()
+        self._nextCall = 1
+        self._health = None
+        self._socketCount = 0
+
+    async def connect(self, timeout=30):
+        # The deck owner may still be starting up, keep trying for a while.
+        self._closed = asyncio.Event()
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            try:
+                (self._reader, self._writer) = await asyncio.open_unix_connection(
+                    path=self.path, limit=message_limit)
+                break
+            except (ConnectionError, FileNotFoundError) as e:
+                if asyncio.get_running_loop().time() >= deadline:
+                    raise
+                self.logger.debug("Waiting for the deck owner: {}".format(e))
+                await asyncio.sleep(0.1)
+
+        self._receiver = asyncio.ensure_future(self._receive())
+        write_message(self._writer, {'sockets': self._socketCount})
+        self.logger.info("Connected to the deck owner on {}".format(self.path))
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    async def close(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+            await asyncio.gather(self._receiver, return_exceptions=True)
+        if self._writer is not None:
+            self._writer.close()
+        self._fail_calls()
+
+    def connectedSockets(self, count=0):
+        if count is not None and (type(count) == int or type(count) == float):
+            self._socketCount = count
+            if self._writer is not None and not self._writer.is_closing():
+                write_message(self._writer, {'sockets': count})
+        return self._socketCount
+
+    def health(self):
+        if self._health is None or self._writer is None or self._writer.is_closing():
+            return {
+                'host': None,
+                'port': None,
+                'state': 'owner unreachable',
+                'connected': False,
+                'pending_commands': 0,
+                'command_age': None,
+                'last_response_age': None,
+            }
+        return self._health
+
+    def isConnected(self):
+        return self.health()['connected']
+
+    def getHost(self):
+        return self.health()['host']
+
+    def getPort(self):
+        return self.health()['port']
+
+    async def setNetwork(self, host=None, port=None):
+        return await self._call('setNetwork', host, port)
+
+    async def record(self):
+        return await self._call('record')
+
+    async def record_named(self, clip_name):
+        return await self._call('record_named', clip_name)
+
+    async def play(self, single=True, loop=False, speed=1.0):
+        return await self._call('play', single, loop, speed)
+
+    async def stop(self):
+        return await self._call('stop')
+
+    async def select_clip_by_index(self, clip_index):
+        return await self._call('select_clip_by_index', clip_index)
+
+    async def select_clip_by_offset(self, clip_offset):
+        return await self._call('select_clip_by_offset', clip_offset)
+
+    async def jog_to_timecode(self, timecode):
+        return await self._call('jog_to_timecode', timecode)
+
+    async def slot_info(self, slot=None):
+        return await self._call('slot_info', slot)
+
+    async def slot_select(self, slot=1):
+        return await self._call('slot_select', slot)
+
+    async def dist_list(self, slot=None):
+        return await self._call('dist_list', slot)
+
+    async def update_clips(self):
+        clips = await self._call('update_clips')
+        if clips is not None:
+            self.clips = clips
+
+    async def update_status(self):
+        status = await self._call('update_status')
+        if status is not None:
+            self.status = status
+        return status is not None
+
+    async def update_slots(self):
+        slots = await self._call('update_slots')
+        if slots is not None:
+            self.slots = slots
+
+    async def _call(self, method, *args):
+        if self._writer is None or self._writer.is_closing():
+            return None
+
+        call = self._nextCall
+        self._nextCall += 1
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call] = future
+
+        # Have the deck owner time the HyperDeck commands of a timed request,
+        # its clock is the same system wide monotonic clock as ours.
+        timing = HyperDeck.request_timing.get()
+        write_message(self._writer, {
+            'call': call,
+            'method': method,
+            'args': list(args),
+            'timed': timing is not None,
+        })
+        reply = await future
+
+        if timing is not None:
+            timing['commands'].extend(reply.get('commands', []))
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply.get('result', None)
+
+    def _fail_calls(self):
+        for future in self._calls.values():
+            if not future.done():
+                future.set_result({'result': None})
+        self._calls = dict()
+
+    async def _receive(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+
+                message = Json.decode(line)
+                if 'reply' in message:
+                    future = self._calls.pop(message['reply'], None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                elif 'event' in message:
+                    event = message['event']
+                    params = message.get('params', None)
+                    if event == EventBus.CLIPS:
+                        self.clips = params
+                    elif event == EventBus.STATUS:
+                        self.status = params
+                    elif event == EventBus.SLOTS:
+                        self.slots = params
+                    self.events.publish(event, params)
+                elif 'health' in message:
+                    self._health = message['health']
+                elif 'snapshot' in message:
+                    # Sent on connecting, and again whenever events to us had
+                    # to be dropped; pass the state on as if it had changed.
+                    snapshot = message['snapshot']
+                    self.clips = snapshot['clips']
+                    self.status = snapshot['status']
+                    self.slots = snapshot['slots']
+                    self._health = snapshot['health']
+                    self.events.publish(EventBus.CLIPS, self.clips)
+                    self.events.publish(EventBus.STATUS, self.status)
+                    self.events.publish(EventBus.SLOTS, self.slots)
+        except Exception as e:
+            self.logger.error("Deck owner connection failed: {}".format(e))
+        finally:
+            self.logger.info("Disconnected from the deck owner.")
+            self._writer.close()
+            self._fail_calls()
+            self._closed.set()
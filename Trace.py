@@ -0,0 +1,90 @@
+import asyncio
+import struct
+import time
+
+# Trace files start with this magic, followed by one record per frame sent to
+# or received from the HyperDeck. Each record is a little-endian header of the
+# wall clock time (float64 seconds), the direction (uint8) and the payload
+# length (uint32), followed by the raw payload bytes.
+MAGIC = b'HDTRACE\x01'
+RECORD = struct.Struct('<dBI')
+
+SENT = 0
+RECEIVED = 1
+
+# Buffered records are flushed to disk at least this often (in seconds).
+flush_interval = 1.0
+
+
+class TraceWriter:
+    def __init__(self, path, buffer_size=64 * 1024):
+        self.path = path
+        self.frames = 0
+
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._lastFlush = time.monotonic()
+        self._flushHandle = None
+
+    def write(self, direction, payload):
+        if self._file is None:
+            return
+
+        self._file.write(RECORD.pack(time.time(), direction, len(payload)))
+        self._file.write(payload)
+        self.frames += 1
+
+        now = time.monotonic()
+        if now - self._lastFlush >= flush_interval:
+            self.flush()
+        elif self._flushHandle is None:
+            # Schedule a flush, so this record reaches the disk in time even
+            # if nothing else is written after it.
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self._flushHandle = loop.call_later(flush_interval - (now - self._lastFlush), self.flush)
+
+    def flush(self):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        if self._file is not None:
+            self._file.flush()
+            self._lastFlush = time.monotonic()
+
+    def close(self):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class TraceReader:
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        # Yields (timestamp, direction, payload) for every record in the file.
+        # A record cut short at the end of the file (e.g. by a crash) is
+        # ignored.
+        with open(self.path, 'rb') as traceFile:
+            if traceFile.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a HyperDeck trace file".format(self.path))
+
+            while True:
+                header = traceFile.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return
+
+                (timestamp, direction, length) = RECORD.unpack(header)
+                payload = traceFile.read(length)
+                if len(payload) < length:
+                    return
+
+                yield (timestamp, direction, payload)
@@ -1,7 +1,9 @@
 import asyncio
 import logging
-import json
+import time
 import base64
+import importlib.util
+from collections import deque
 
 try:
     import aiohttp
@@ -11,10 +13,10 @@ except ImportError:
     import sys
     sys.exit(1)
 
-try:
-    from aiohttp_session import setup as setup_session
-    from aiohttp_session.cookie_storage import EncryptedCookieStorage
-except ImportError:
+# aiohttp_session and cryptography are only needed once a request touches the
+# login session, so they are imported on first use (see
+# _create_session_middleware) to keep the start up path short.
+if importlib.util.find_spec('aiohttp_session') is None or importlib.util.find_spec('cryptography') is None:
     print(
         "The aiohttp_session or cryptography library was not found. Please install them via `pip3 install aiohttp_security[session]` and `pip3 install cryptography` and try again.")
     import sys
@@ -32,29 +34,154 @@ except ImportError:
     import sys
     sys.exit(1)
 
+import Commands
+import EventBus
+import HyperDeck
+import Json
+import Macro
 from login.authz import DictionaryAuthorizationPolicy, check_credentials
 from login.users import user_map
 from middlewares import setup_middlewares
 
 
+# A HyperDeck command still waiting for its response after this many seconds
+# means the control connection is wedged, and the process should be restarted.
+command_timeout = 10
+
+# Server side latency budget (in milliseconds, from the websocket message
+# arriving to the HyperDeck acknowledging it) for the transport commands an
+# operator is waiting on. Requests over budget are logged as warnings.
+latency_budget = 50
+latency_budget_commands = ('record', 'record_named', 'stop')
+
+# Paths served without loading the login session.
+sessionless_paths = ('/healthz', '/readyz')
+
+# Inbound websocket requests allowed per connection, as a sustained rate per
+# second and a burst size.
+inbound_rate = 20
+inbound_burst = 40
+
+# Commands that only fetch state: a request identical to one still waiting
+# to be handled is merged into it. For superseding commands only the latest
+# waiting request matters, so a new one replaces the one waiting.
+idempotent_commands = frozenset([
+    'refresh', 'hyperdeck', 'hyperdeck-status', 'slots', 'getNetwork', 'state_refresh',
+    'clip_refresh', 'slot_refresh', 'slot_info', 'dist_list',
+])
+superseding_commands = frozenset(['clip_jog'])
+
+# Transport commands an operator is waiting on are never rate limited, so a
+# flood of other requests (e.g. dragging the jog slider) can't block them.
+unlimited_commands = frozenset(['record', 'record_named', 'stop', 'play'])
+
+# Most status updates broadcast to the websocket clients per second, 0 sends
+# every one. Status updates arriving faster are coalesced, so only the newest
+# is sent once the interval has passed.
+max_status_rate = 10
+
+
+class RequestQueue:
+    # Decoded requests from one websocket connection waiting to be handled,
+    # rate limited with a token bucket. Repeated state refreshes are merged
+    # rather than queued up behind a slow HyperDeck.
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate or inbound_rate
+        self.burst = burst or inbound_burst
+        self.merged = 0
+        self.limited = 0
+
+        self._requests = deque()
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def put(self, request, timing=None):
+        # Returns False if the request was dropped for exceeding the rate.
+        command = request.get('command', None)
+        # Only the last waiting request is merged with, so requests are
+        # always handled in the order they were sent.
+        if self._requests and (command in idempotent_commands or command in superseding_commands):
+            (waiting, _) = self._requests[-1]
+            if waiting.get('command', None) == command:
+                if command in superseding_commands:
+                    self._requests[-1] = (request, timing)
+                    self.merged += 1
+                    return True
+                if waiting.get('params', None) == request.get('params', None):
+                    self.merged += 1
+                    return True
+
+        if command not in unlimited_commands:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                self.limited += 1
+                return False
+            self._tokens -= 1
+
+        self._requests.append((request, timing))
+        self._ready.set()
+        return True
+
+    def close(self):
+        # No more requests will arrive. The requests waiting are still
+        # handled, except state queries nobody is left to read the reply to.
+        self._closed = True
+        self._requests = deque(
+            (request, timing) for (request, timing) in self._requests
+            if request.get('command', None) not in idempotent_commands)
+        self._ready.set()
+
+    async def get(self):
+        # Returns None once the queue is closed and empty.
+        while not self._requests:
+            if self._closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        return self._requests.popleft()
+
+    def __len__(self):
+        return len(self._requests)
+
+
 class WebUI:
     logger = logging.getLogger(__name__)
 
-    def __init__(self, address=None, port=None, key=None, session=None, loop=None):
+    def __init__(self, address=None, port=None, key=None, session=None, loop=None, status_rate=None):
         self.address = address or 'localhost'
         self.port = port or 8080
+        self.status_rate = max_status_rate if status_rate is None else status_rate
         if (key == None or len(key) < 32):
             self.session_key = '=-0JdLGhHOrA1iKD5dvyw9hhmgH5aXKJIRlqy0PMAIv4='
         else:
             self.session_key = key
         self.session_cookie = session or 'HYPER_UI_SESSION'
 
-        self._loop = loop or asyncio.get_event_loop()
+        self._loop = loop
         self._hyperdeck = None
+        self._macros = None
         self._app = None
-
-    async def start(self, hyperdeck):
+        self._runner = None
+        self._command_handlers = self._create_command_handlers()
+        self._ready = False
+        self._session_middleware = None
+        self._events = None
+        self._events_task = None
+        self._request_workers = set()
+        self._batches = dict()
+
+    async def start(self, hyperdeck, sock=None):
         self._hyperdeck = hyperdeck
+        self._macros = Macro.MacroEngine(hyperdeck)
+
+        # Receive HyperDeck state changes through our own queue on the event
+        # bus, so slow websocket clients never hold up the deck connection.
+        self._events = hyperdeck.events.subscribe()
+        self._events_task = asyncio.ensure_future(self._dispatch_events())
 
         # Add routes for the static front-end HTML file, the websocket, and the resources directory.
         app = web.Application()
@@ -72,15 +199,11 @@ class WebUI:
         app.router.add_post(
             '/logout', self._http_post_logout, name='post_logout')
         app.router.add_get('/ws', self._http_request_get_websocket, name="ws")
+        app.router.add_get('/healthz', self._http_request_get_healthz, name='healthz')
+        app.router.add_get('/readyz', self._http_request_get_readyz, name='readyz')
         app.router.add_static('/resources/', path=str('./WebUI/Resources/'))
 
-        # secret_key must be 32 url-safe base64-encoded bytes
-        fernet_key = "-0JdLGhHOrA1iKD5dvyw9hhmgH5aXKJIRlqy0PMAIv4="
-        secret_key = base64.urlsafe_b64decode(fernet_key)
-
-        storage = EncryptedCookieStorage(
-            secret_key, cookie_name=self.session_cookie)
-        setup_session(app, storage)
+        app.middlewares.append(self._lazy_session_middleware)
 
         policy = SessionIdentityPolicy()
         setup_security(app, policy, DictionaryAuthorizationPolicy(user_map))
@@ -91,7 +214,73 @@ class WebUI:
 
         self.logger.info(
             "Starting web server on {}:{}".format(self.address, self.port))
-        return await self._loop.create_server(app.make_handler(), self.address, self.port)
+        self._runner = web.AppRunner(app, handle_signals=False)
+        await self._runner.setup()
+        if sock is not None:
+            # Serve on a socket the caller has already bound and is listening
+            # on, connections made before now are waiting in its backlog.
+            site = web.SockSite(self._runner, sock)
+        else:
+            site = web.TCPSite(self._runner, self.address, self.port)
+        await site.start()
+        self._ready = True
+        return site
+
+    def _create_session_middleware(self):
+        from aiohttp_session import session_middleware
+        from aiohttp_session.cookie_storage import EncryptedCookieStorage
+
+        # secret_key must be 32 url-safe base64-encoded bytes
+        fernet_key = "-0JdLGhHOrA1iKD5dvyw9hhmgH5aXKJIRlqy0PMAIv4="
+        secret_key = base64.urlsafe_b64decode(fernet_key)
+
+        storage = EncryptedCookieStorage(
+            secret_key, cookie_name=self.session_cookie)
+        return session_middleware(storage)
+
+    @web.middleware
+    async def _lazy_session_middleware(self, request, handler):
+        # Static resources and health checks never use the session, skip
+        # loading the session storage for them.
+        if request.path.startswith('/resources/') or request.path in sessionless_paths:
+            return await handler(request)
+
+        if self._session_middleware is None:
+            self._session_middleware = self._create_session_middleware()
+        return await self._session_middleware(request, handler)
+
+    async def stop(self, timeout=5):
+        # Gracefully shut down the web server: tell every connected websocket
+        # client we are going away (flushing anything still queued on them),
+        # then stop accepting connections and tear down the application.
+        if self._runner is None:
+            return
+
+        self.logger.info("Stopping web server.")
+        sockets = list(self._app.sockets)
+        if sockets:
+            closers = [ws.close(code=aiohttp.WSCloseCode.GOING_AWAY, message=b'Server shutdown')
+                       for ws in sockets if not ws.closed]
+            try:
+                await asyncio.wait_for(asyncio.gather(*closers, return_exceptions=True), timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning("Timed out closing websocket connections.")
+
+        # Let the requests the clients sent before going away finish.
+        workers = list(self._request_workers)
+        if workers:
+            done, pending = await asyncio.wait(workers, timeout=timeout)
+            if pending:
+                self.logger.warning("Timed out finishing {} websocket request worker(s).".format(len(pending)))
+                for worker in pending:
+                    worker.cancel()
+
+        self._events.close()
+        await asyncio.gather(self._events_task, return_exceptions=True)
+
+        await self._runner.cleanup()
+        self._runner = None
+        self._ready = False
 
     async def _http_request_get_index(self, request):
         response = web.HTTPFound('/login')
@@ -142,19 +331,45 @@ class WebUI:
     async def _http_request_get_hyperdeck_status(self, request):
         return web.FileResponse(path=str('WebUI/hyperdeck-status.html'))
 
+    def _health(self):
+        # Health and readiness are reported purely from cached state, so
+        # probing never costs a round trip to the HyperDeck.
+        hyperdeck = self._hyperdeck.health()
+        command_age = hyperdeck['command_age']
+        return {
+            'ready': self._ready and hyperdeck['connected'],
+            'healthy': command_age is None or command_age < command_timeout,
+            'websockets': len(self._app.sockets),
+            'hyperdeck': hyperdeck,
+        }
+
+    async def _http_request_get_healthz(self, request):
+        # Liveness: fails only when a deck command has been stuck waiting for
+        # a response, a disconnected deck is retried on its own.
+        health = self._health()
+        return web.json_response(health, status=200 if health['healthy'] else 503)
+
+    async def _http_request_get_readyz(self, request):
+        # Readiness: the web UI is serving and the deck is connected.
+        health = self._health()
+        return web.json_response(health, status=200 if health['ready'] else 503)
+
     async def _http_request_get_websocket(self, request):
         resp = web.WebSocketResponse()
         await resp.prepare(request)
 
+        # Requests are handled one at a time by a worker, in the order they
+        # arrived, while we keep reading (and merging) new ones.
+        requests = RequestQueue()
+        worker = asyncio.ensure_future(self._process_requests(requests, resp))
+        self._request_workers.add(worker)
+        worker.add_done_callback(self._request_workers.discard)
+
         try:
             if not resp in self._app.sockets:
                 self._app.sockets.append(resp)
                 self._hyperdeck.connectedSockets(len(self._app.sockets))
 
-            if self._hyperdeck.hasCallback() == False:
-                await self._hyperdeck.set_callback(self._hyperdeck_event)
-                self.logger.debug("Set HyperDeck callback.")
-
             self.logger.debug(
                 "({}) Websocket Connection Opened.".format(len(self._app.sockets)))
 
@@ -168,25 +383,28 @@ class WebUI:
 
             async for msg in resp:
                 if msg.type == web.WSMsgType.TEXT:
-                    request = json.JSONDecoder().decode(msg.data)
+                    received = time.perf_counter()
+                    try:
+                        request = Json.decode(msg.data)
+                        if not isinstance(request, dict):
+                            raise ValueError("request must be an object")
+                    except ValueError as e:
+                        await self._send_request_error(dict(), "Malformed request: {}".format(e), resp)
+                        continue
+                    decoded = time.perf_counter()
                     self.logger.debug(
                         "Request: {}".format(request))
 
-                    try:
-                        request['_ws'] = resp
-                        await self._websocket_request_handler(request)
-                    except Exception as e:
-                        message = {
-                            'response': 'request_error',
-                            'params': {
-                                'command': request.get('command', ""),
-                                'params': request.get('params', dict()),
-                                'message': "{}".format(e),
-                            }
-                        }
-                        await self._send_websocket_message(message, resp)
-                        self.logger.error(
-                            "_http_request_get_websocket _websocket_request_handler failed: {}".format(e))
+                    # Requests carrying a correlation id get their hop
+                    # timestamps recorded and returned in a latency message.
+                    timing = None
+                    if request.get('id', None) is not None:
+                        timing = {'received': received, 'decoded': decoded, 'commands': []}
+
+                    if not requests.put(request, timing):
+                        self.logger.warning(
+                            "Websocket request rate exceeded, dropped '{}'.".format(request.get('command', "")))
+                        await self._send_request_error(request, "Too many requests", resp)
                 elif msg.type == web.WSMsgType.ERROR:
                     self.logger.debug(
                         "Websocket exception: {}".format(resp.exception()))
@@ -196,86 +414,199 @@ class WebUI:
             return resp
 
         finally:
+            # The worker finishes the requests already received (e.g. a stop
+            # sent just before the page reloads) in the background.
+            requests.close()
             if resp in self._app.sockets:
                 self._app.sockets.remove(resp)
                 self._hyperdeck.connectedSockets(len(self._app.sockets))
             self.logger.debug("({}) Websocket Connection Closed.".format(
                 len(self._app.sockets)))
 
-    async def _websocket_request_handler(self, request):
-        ws = request.get('_ws', None)
+    async def _process_requests(self, requests, ws):
+        while True:
+            item = await requests.get()
+            if item is None:
+                return
+            (request, timing) = item
+            token = HyperDeck.request_timing.set(timing)
+
+            try:
+                await self._websocket_request_handler(request, ws)
+            except Exception as e:
+                await self._send_request_error(request, "{}".format(e), ws)
+                self.logger.error(
+                    "_process_requests _websocket_request_handler failed: {}".format(e))
+            finally:
+                HyperDeck.request_timing.reset(token)
+
+            if timing is not None:
+                timing['handled'] = time.perf_counter()
+                await self._send_latency(request, timing, ws)
+
+    async def _send_request_error(self, request, error, ws):
+        message = {
+            'response': 'request_error',
+            'params': {
+                'id': request.get('id', None),
+                'command': request.get('command', ""),
+                'params': request.get('params', dict()),
+                'message': error,
+            }
+        }
+        await self._send_websocket_message(message, ws)
+
+    def _create_command_handlers(self):
+        # Front-end websocket commands, each with its handler and the compiled
+        # params it accepts. Handlers are passed the request's (top-level)
+        # correlation id. HyperDeck actions are shared with batch steps.
+        handlers = {
+            'refresh': (self._command_refresh, Commands.no_params),
+            'hyperdeck': (self._command_hyperdeck, Commands.no_params),
+            'hyperdeck-status': (self._command_hyperdeck_status, Commands.no_params),
+            'slots': (self._command_slots, Commands.no_params),
+            'getNetwork': (self._command_get_network, Commands.no_params),
+            'updateNetwork': (self._command_update_network, Commands.compile_params({
+                'host': (Commands.string, None),
+                'port': (Commands.integer, None),
+            })),
+            'batch': (self._command_batch, Commands.compile_params({
+                'steps': (Commands.array, []),
+                'stop_on_error': (Commands.boolean, True),
+            })),
+        }
+
+        def deck_action(action):
+            return lambda ws, params, request_id: action(self._hyperdeck, params)
+
+        for (command, (action, parse)) in Commands.actions.items():
+            handlers[command] = (deck_action(action), parse)
+        return handlers
+
+    async def _websocket_request_handler(self, request, ws=None):
         command = request.get('command')
-        params = request.get('params', dict())
+        handler = self._command_handlers.get(command, None)
+        if handler is None:
+            raise ValueError("Unknown command '{}'".format(command))
 
-        # Process the various commands the front-end can send via the websocket.
-        if command == "refresh":
-            await self._hyperdeck_event('clips')
-            await self._hyperdeck_event('status')
-        elif command == 'hyperdeck':
-            message = {
-                'response': 'hyperdeck_load',
-                'params': {
-                    'host': self._hyperdeck.getHost(),
-                    'port': self._hyperdeck.getPort(),
-                }
+        (handle, parse) = handler
+        await handle(ws, parse(request.get('params', None)), request.get('id', None))
+
+    async def _command_refresh(self, ws, params, request_id):
+        await self._hyperdeck_event(EventBus.CLIPS, self._hyperdeck.clips)
+        await self._hyperdeck_event(EventBus.STATUS, self._hyperdeck.status)
+        await self._hyperdeck_event(EventBus.SLOTS, self._hyperdeck.slots)
+
+    async def _command_hyperdeck(self, ws, params, request_id):
+        message = {
+            'response': 'hyperdeck_load',
+            'params': {
+                'host': self._hyperdeck.getHost(),
+                'port': self._hyperdeck.getPort(),
             }
-            await self._send_websocket_message(message, ws)
-        elif command == 'hyperdeck-status':
-            await self._hyperdeck.update_status()
-        elif command == "getNetwork":
-            message = {
-                'response': 'network',
-                'params': {
-                    'host': self._hyperdeck.getHost(),
-                    'port': self._hyperdeck.getPort(),
-                }
+        }
+        await self._send_websocket_message(message, ws)
+
+    async def _command_hyperdeck_status(self, ws, params, request_id):
+        await self._hyperdeck.update_status()
+
+    async def _command_slots(self, ws, params, request_id):
+        # Answered from the cached slot inventory, without asking the
+        # HyperDeck.
+        message = {
+            'response': 'slots',
+            'params': self._hyperdeck.slots
+        }
+        await self._send_websocket_message(message, ws)
+
+    async def _command_get_network(self, ws, params, request_id):
+        message = {
+            'response': 'network',
+            'params': {
+                'host': self._hyperdeck.getHost(),
+                'port': self._hyperdeck.getPort(),
             }
-            await self._send_websocket_message(message, ws)
-        if command == "updateNetwork":
-            oldHost = self._hyperdeck.getHost()
-            oldPort = self._hyperdeck.getPort()
-            newHost = params.get('host', oldHost)
-            newPort = params.get('port', oldPort)
-            if (newHost != oldHost or newPort != oldPort):
-                await self._hyperdeck.setNetwork(host=newHost, port=newPort)
-        elif command == "record":
-            await self._hyperdeck.record()
-        elif command == "record_named":
-            clip_name = params.get('clip_name', '')
-            recordResponse = await self._hyperdeck.record_named(clip_name)
-            self.logger.info(recordResponse);
-        elif command == "play":
-            single = params.get('single', False)
-            loop = params.get('loop', False)
-            speed = params.get('speed', 1.0)
-
-            await self._hyperdeck.play(single=single, loop=loop, speed=speed)
-        elif command == "stop":
-            await self._hyperdeck.stop()
-        elif command == "state_refresh":
-            await self._hyperdeck.update_status()
-        elif command == "clip_select":
-            clip_index = params.get('id', 0)
-
-            await self._hyperdeck.select_clip_by_index(clip_index)
-        elif command == "clip_refresh":
-            await self._hyperdeck.update_clips()
-        elif command == "clip_previous":
-            await self._hyperdeck.select_clip_by_offset(-1)
-        elif command == "clip_next":
-            await self._hyperdeck.select_clip_by_offset(1)
-        elif command == "clip_jog":
-            timecode = params.get('timecode', '00:00:00;00')
-            await self._hyperdeck.jog_to_timecode(timecode)
-        elif command == "slot_info":
-            slot = params.get('slot', None)
-            await self._hyperdeck.slot_info(slot)
-        elif command == "slot_select":
-            slot = params.get('slot', 1)
-            await self._hyperdeck.slot_select(slot)
-        elif command == "dist_list":
-            slot = params.get('slot', None)
-            await self._hyperdeck.dist_list(slot)
+        }
+        await self._send_websocket_message(message, ws)
+
+    async def _command_update_network(self, ws, params, request_id):
+        oldHost = self._hyperdeck.getHost()
+        oldPort = self._hyperdeck.getPort()
+        newHost = params['host'] or oldHost
+        newPort = params['port'] or oldPort
+        if (newHost != oldHost or newPort != oldPort):
+            await self._hyperdeck.setNetwork(host=newHost, port=newPort)
+
+    async def _command_batch(self, ws, params, request_id):
+        # Run a list of HyperDeck commands (and waits on status values) in
+        # one request, replying with the result of every step. A batch runs
+        # in its own task, so the requests sent after it (e.g. stop) aren't
+        # held up until it finishes; a connection's batches still run one at
+        # a time, in order.
+        self._macros.validate(params['steps'])
+        previous = self._batches.get(ws, None)
+        batch = asyncio.ensure_future(self._run_batch(ws, params, request_id, previous))
+        self._batches[ws] = batch
+        self._request_workers.add(batch)
+
+        def batch_done(task):
+            self._request_workers.discard(task)
+            if self._batches.get(ws, None) is task:
+                del self._batches[ws]
+
+        batch.add_done_callback(batch_done)
+
+    async def _run_batch(self, ws, params, request_id, previous=None):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+
+        try:
+            results = await self._macros.run(params['steps'], stop_on_error=params['stop_on_error'])
+        except Exception as e:
+            self.logger.error("Batch failed: {}".format(e))
+            await self._send_request_error(
+                {'id': request_id, 'command': 'batch', 'params': params}, "{}".format(e), ws)
+            return
+        message = {
+            'response': 'batch_result',
+            'params': {
+                'id': request_id,
+                'ok': all(result['status'] == 'ok' for result in results),
+                'results': results,
+            }
+        }
+        await self._send_websocket_message(message, ws)
+
+    async def _send_latency(self, request, timing, ws):
+        # Report how long each hop of the request took, in milliseconds
+        # since the websocket message arrived.
+        def since(timestamp):
+            return round((timestamp - timing['received']) * 1000, 3)
+
+        command = request.get('command', "")
+        commands = [{
+            'command': sent['command'],
+            'ahead': sent['ahead'],
+            'queued': since(sent['queued']),
+            'written': since(sent['written']),
+            'ack': since(sent['ack']),
+        } for sent in timing['commands']]
+        message = {
+            'response': 'latency',
+            'params': {
+                'id': request.get('id'),
+                'command': command,
+                'decoded': since(timing['decoded']),
+                'commands': commands,
+                'handled': since(timing['handled']),
+            }
+        }
+
+        if command in latency_budget_commands and commands and commands[-1]['ack'] > latency_budget:
+            self.logger.warning("'{}' request {} took {} ms to be acknowledged, over the {} ms budget: {}".format(
+                command, request.get('id'), commands[-1]['ack'], latency_budget, message['params']))
+
+        await self._send_websocket_message(message, ws)
 
     async def _send_websocket_message(self, message, socket=None):
         if socket is None:
@@ -286,7 +617,7 @@ class WebUI:
                 return None
 
         # Encode the message as a JSON message
-        message_json = json.JSONEncoder().encode(message)
+        message_json = Json.encode(message)
         self.logger.debug("Response: {}".format(message_json))
         # First define our response variable
         response = None
@@ -299,7 +630,7 @@ class WebUI:
                         return None
                     else:
                         response = await ws.send_str(message_json)
-            else:
+            elif not socket.closed:
                 response = await socket.send_str(message_json)
         except Exception as e:
             self.logger.error(
@@ -310,13 +641,48 @@ class WebUI:
             else:
                 return ""
 
+    async def _dispatch_events(self):
+        # Forward events from the HyperDeck's event bus to the websocket
+        # clients, one at a time in the order they were published. Status
+        # updates are capped at status_rate per second: one arriving too soon
+        # is held back, replacing any already held, and sent when its
+        # interval is up.
+        interval = 1.0 / self.status_rate if self.status_rate > 0 else 0
+        held = None
+        lastStatus = None
+
+        while True:
+            timeout = None
+            if held is not None:
+                timeout = max(lastStatus + interval - time.monotonic(), 0)
+            try:
+                event = await asyncio.wait_for(self._events.get(), timeout)
+            except asyncio.TimeoutError:
+                (event, held) = (held, None)
+            else:
+                if event is None:
+                    break
+                if event.type == EventBus.STATUS and (held is not None or (
+                        lastStatus is not None and time.monotonic() - lastStatus < interval)):
+                    held = event
+                    continue
+
+            if event.type == EventBus.STATUS:
+                lastStatus = time.monotonic()
+            try:
+                await self._hyperdeck_event(event.type, event.params)
+            except Exception as e:
+                self.logger.error(
+                    "_dispatch_events failed for '{}': {}".format(event.type, e))
+
     async def _hyperdeck_event(self, event, params=None):
         # HyperDeck state change event handlers, one per supported event type.
         event_handlers = {
-            'clips': self._hyperdeck_event_clips_changed,
-            'status': self._hyperdeck_event_status_changed,
-            'transcript': self._hyperdeck_event_transcript,
-            'error': self._hyperdeck_event_error,
+            EventBus.CLIPS: self._hyperdeck_event_clips_changed,
+            EventBus.STATUS: self._hyperdeck_event_status_changed,
+            EventBus.TRANSCRIPT: self._hyperdeck_event_transcript,
+            EventBus.SLOTS: self._hyperdeck_event_slots_changed,
+            EventBus.ERROR: self._hyperdeck_event_error,
         }
 
         handler = event_handlers.get(event)
@@ -326,16 +692,17 @@ class WebUI:
     async def _hyperdeck_event_clips_changed(self, params):
         # First send a new clip count update. this clears the clip list in the
         # front-end and prepares it to receive new clip entries/
+        clips = params if params is not None else self._hyperdeck.clips
         message = {
             'response': 'clip_count',
             'params': {
-                'count': len(self._hyperdeck.clips)
+                'count': len(clips)
             }
         }
         await self._send_websocket_message(message)
 
         # Next, send through clip info updates to the front-end, one per clip.
-        for index, clip in enumerate(self._hyperdeck.clips):
+        for index, clip in enumerate(clips):
             message = {
                 'response': 'clip_info',
                 'params': {
@@ -351,7 +718,7 @@ class WebUI:
         # Send the new HyperDeck status to the front-end for display.
         message = {
             'response': 'status',
-            'params': self._hyperdeck.status
+            'params': params if params is not None else self._hyperdeck.status
         }
         await self._send_websocket_message(message)
 
@@ -364,6 +731,14 @@ class WebUI:
         }
         await self._send_websocket_message(message)
 
+    async def _hyperdeck_event_slots_changed(self, params):
+        # Send the new slot inventory to the front-end for display.
+        message = {
+            'response': 'slots',
+            'params': params if params is not None else self._hyperdeck.slots
+        }
+        await self._send_websocket_message(message)
+
     async def _hyperdeck_event_error(self, params):
         # Display an error to the user.
         message = {
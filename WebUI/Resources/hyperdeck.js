@@ -29,6 +29,8 @@ let clips_name = document.getElementById("clips_name");
 let btnLogout = document.getElementById("btnLogout");
 let ip_addr = document.getElementById("ip_addr");
 let port = document.getElementById("port");
+let latency_debug = document.getElementById("latency_debug");
+let latency = document.getElementById("latency");
 
 // Websocket used to communicate with the Python server backend
 let ws = new WebSocket("ws://" + location.host + "/ws");
@@ -39,6 +41,8 @@ let ws = new WebSocket("ws://" + location.host + "/ws");
 let allow_state_transcript = true;
 
 let initialLoad = true;
+// The slot the HyperDeck is using, from its transport status
+let activeSlot = 0;
 let videoFormat = "1080i5994";
 let fps = 59.94;
 let dropFrame = true;
@@ -55,6 +59,14 @@ let is_updating = false;
 let auto_refresh = false;
 let diskAlerted = false;
 
+// Correlation ids for timed requests, and the browser side timestamps of
+// each request still waiting for its latency report. Open the page with
+// ?debug=1 to show the latency breakdown.
+let debug = false;
+let next_request_id = 1;
+let timed_requests = {};
+const latency_history = 20;
+
 const getUrlVars = () => {
   let vars = {};
   let parts = window.location.href.replace(
@@ -94,6 +106,60 @@ const setDropFrame = (timecodeData = "00:00:00;00") => {
   }
 };
 
+const setFrameRate = (videoFormat = "") => {
+  // Pick the frame rate out of a video format such as "1080p2997"
+  if (videoFormat.indexOf("2997") >= 0) fps = 29.97;
+  else if (videoFormat.indexOf("30") >= 0) fps = 30;
+  else if (videoFormat.indexOf("5994") >= 0) fps = 59.94;
+  else if (videoFormat.indexOf("60") >= 0) fps = 60.0;
+};
+
+const formatRecordingTime = (seconds = 0) => {
+  // Remaining recording time in seconds as h:mm:ss
+  const hours = Math.floor(seconds / 3600);
+  const minutes = String(Math.floor((seconds % 3600) / 60)).padStart(2, "0");
+  return hours + ":" + minutes + ":" + String(seconds % 60).padStart(2, "0");
+};
+
+const updateSlots = (slots = {}) => {
+  // Show each slot's media and remaining recording time, and only allow
+  // selecting slots that have media mounted.
+  let mounted = 0;
+  for (const slotId in slots) {
+    const slotNumber = Number(slotId);
+    const option = slot_select.options[slotNumber];
+    if (option === undefined) continue;
+
+    const slot = slots[slotId];
+    if (slot["status"] === "mounted") {
+      mounted++;
+      option.disabled = false;
+      option.text =
+        " " +
+        slotId +
+        " - " +
+        slot["volume name"] +
+        " [" +
+        formatRecordingTime(slot["recording time"]) +
+        " left] ";
+    } else {
+      option.disabled = true;
+      option.text = " " + slotId + " ";
+      if (slot_select.selectedIndex == slotNumber) slot_select.selectedIndex = 0;
+    }
+  }
+
+  slot_select.disabled = mounted === 0;
+  selectActiveSlot();
+};
+
+const selectActiveSlot = () => {
+  // Show the slot the HyperDeck is using, if it has media mounted.
+  const option = slot_select.options[activeSlot];
+  if (activeSlot > 0 && option !== undefined && !option.disabled)
+    slot_select.selectedIndex = activeSlot;
+};
+
 const updateTimecode = (frames = 0, overrideLastFrame = false) =>
   new Promise((resolve, reject) => {
     try {
@@ -136,6 +202,45 @@ const resetJog = () => {
   return updateTimecode(Math.round(jog.value), true);
 };
 
+// Send a command tagged with a correlation id; the server replies with a
+// "latency" message breaking down where the time went.
+const sendTimedCommand = (command, clicked = performance.now()) => {
+  command.id = next_request_id++;
+  timed_requests[command.id] = {
+    command: command.command,
+    clicked: clicked,
+    sent: performance.now(),
+  };
+  ws.send(JSON.stringify(command));
+};
+
+const showLatency = (params) => {
+  const request = timed_requests[params["id"]];
+  if (request === undefined) return;
+  delete timed_requests[params["id"]];
+  if (!debug) return;
+
+  const roundTrip = performance.now() - request.sent;
+  let line =
+    `#${params["id"]} ${params["command"]}: ` +
+    `click→send ${(request.sent - request.clicked).toFixed(1)}, ` +
+    `decode ${params["decoded"].toFixed(1)}`;
+  let previous = params["decoded"];
+  for (const sent of params["commands"]) {
+    line +=
+      ` | ${sent["command"]}: queue ${(sent["written"] - previous).toFixed(1)}` +
+      (sent["ahead"] > 0 ? ` (${sent["ahead"]} ahead)` : "") +
+      `, deck ack ${(sent["ack"] - sent["written"]).toFixed(1)}`;
+    previous = sent["written"];
+  }
+  line +=
+    ` | server ${params["handled"].toFixed(1)}, round trip ${roundTrip.toFixed(1)} ms`;
+
+  const lines = latency.innerHTML.length ? latency.innerHTML.split("\n") : [];
+  lines.unshift(line);
+  latency.innerHTML = lines.slice(0, latency_history).join("\n");
+};
+
 const refreshClips = () => {
   const command = {
     command: "clip_refresh",
@@ -154,11 +259,11 @@ const refreshState = () => {
   allow_state_transcript = true;
 };
 
-const stopHD = () => {
+const stopHD = (clicked = performance.now()) => {
   const command = {
     command: "stop",
   };
-  ws.send(JSON.stringify(command));
+  sendTimedCommand(command, clicked);
   is_playing = false;
   disableElement(live_div, false);
   setTimeout(() => {
@@ -170,6 +275,9 @@ const stopHD = () => {
     if (clips_name.value !== "Capture") {
       params.push(`clipsName=${clips_name.value.trim()}`);
     }
+    if (debug) {
+      params.push("debug=1");
+    }
     if (params.length <= 0) window.location = `${loc.origin}/hyperdeck`;
     else window.location = `${loc.origin}/hyperdeck?${params.join("&")}`;
   }, 100);
@@ -223,6 +331,7 @@ jog.onchange = () => {
 };
 
 record.onclick = () => {
+  const clicked = performance.now();
   const command = {
     command: "record_named",
     params: {
@@ -230,13 +339,14 @@ record.onclick = () => {
     },
   };
 
-  ws.send(JSON.stringify(command));
+  sendTimedCommand(command, clicked);
   is_playing = false;
   auto_refresh = true;
   disableElement(live_div, true);
 };
 
 play.onclick = () => {
+  const clicked = performance.now();
   const command = {
     command: "play",
     params: {
@@ -245,12 +355,12 @@ play.onclick = () => {
       speed: speed.value,
     },
   };
-  ws.send(JSON.stringify(command));
+  sendTimedCommand(command, clicked);
   is_playing = true;
 };
 
 stop.onclick = () => {
-  stopHD();
+  stopHD(performance.now());
 };
 
 prev.onclick = () => {
@@ -362,17 +472,9 @@ slot_select.onchange = () => {
   };
   ws.send(JSON.stringify(command));
 
+  // The slot inventory is pushed by the server, only the clips need a refresh.
   setTimeout(() => {
     refreshClips();
-
-    if (newSlot == 0) return;
-    const command = {
-      command: "slot_info",
-      params: {
-        slot: newSlot,
-      },
-    };
-    ws.send(JSON.stringify(command));
   }, 500);
 };
 
@@ -418,6 +520,10 @@ ws.onmessage = (message) => {
 
       break;
 
+    case "slots":
+      updateSlots(data.params);
+      break;
+
     case "network":
       ip_addr.value = data.params["host"];
       port.value = data.params["port"];
@@ -425,10 +531,22 @@ ws.onmessage = (message) => {
 
     case "status":
       const status = data.params["status"];
+
+      // Follow the HyperDeck when its active slot changes
+      const statusSlot = Number(data.params["slot id"]);
+      if (statusSlot > 0 && statusSlot !== activeSlot) {
+        activeSlot = statusSlot;
+        selectActiveSlot();
+      }
+
       if (status !== undefined) {
         const paramsTC = data.params["timecode"];
 
+        // Status polls aren't sent as transcripts, so keep the frame rate
+        // up to date from the status itself.
         setDropFrame(paramsTC);
+        if (data.params["video format"] !== undefined)
+          setFrameRate(data.params["video format"]);
         if (status === "record") {
           const paramsDisplayTC = data.params["display timecode"];
 
@@ -531,30 +649,7 @@ ws.onmessage = (message) => {
         const paramsReceived = data.params["received"];
         const sentMessage = paramsSent.join("\n").trim();
         const receivedMessage = paramsReceived.join("\n").trim();
-        if (sentMessage.indexOf("slot info") >= 0) {
-          if (paramsReceived[0].toString().trim() == "105 no disk") {
-            slot_select.selectedIndex = 0;
-            slot_select.disabled = true;
-          } else {
-            if (paramsReceived[1].indexOf("slot id: ") >= 0) {
-              const slotNumber = Number(
-                paramsReceived[1].toString().replace("slot id: ", "").trim()
-              );
-              if (slotNumber !== NaN) slot_select.selectedIndex = slotNumber;
-            }
-            slot_select.disabled = false;
-          }
-        } else if (sentMessage.indexOf("disk list") >= 0) {
-          const slotNumber = Number(
-            sentMessage.replace("disk list: slot id: ", "").trim()
-          );
-
-          if (paramsReceived[0].toString().trim() == "105 no disk") {
-            slot_select.options[slotNumber].disabled = true;
-            if (slot_select.selectedIndex == slotNumber)
-              slot_select.selectedIndex = 0;
-          } else slot_select.options[slotNumber].disabled = false;
-        } else if (
+        if (
           !diskAlerted &&
           (sentMessage.toLowerCase().indexOf("disk full") >= 0 ||
             receivedMessage.toLowerCase().indexOf("disk full") >= 0)
@@ -581,10 +676,7 @@ ws.onmessage = (message) => {
             let videoFormatData = paramsReceived[8];
             if (videoFormatData.indexOf("video format:") >= 0) {
               videoFormat = videoFormatData.replace("video format:", "").trim();
-              if (videoFormat.indexOf("2997") >= 0) fps = 29.97;
-              else if (videoFormat.indexOf("30") >= 0) fps = 30;
-              else if (videoFormat.indexOf("5994") >= 0) fps = 59.94;
-              else if (videoFormat.indexOf("60") >= 0) fps = 60.0;
+              setFrameRate(videoFormat);
             }
           }
         }
@@ -604,31 +696,24 @@ ws.onmessage = (message) => {
         })
       );
 
+      // The refresh above sends the cached slot inventory, so only the
+      // clips are fetched from the HyperDeck again.
       ws.send(
         JSON.stringify({
-          command: "dist_list",
-          params: {
-            slot: 1,
-          },
+          command: "clip_refresh",
         })
       );
 
-      ws.send(
-        JSON.stringify({
-          command: "dist_list",
-          params: {
-            slot: 2,
-          },
-        })
-      );
+      break;
 
-      ws.send(
-        JSON.stringify({
-          command: "slot_info",
-        })
-      );
+    case "latency":
+      showLatency(data.params);
 
-      refreshClips();
+      break;
+
+    case "batch_result":
+      if (!data.params["ok"])
+        console.error("Batch failed", data.params["results"]);
 
       break;
 
@@ -673,6 +758,9 @@ window.onload = () => {
   if (slotIndex.length > 0 && !slot_select.disabled)
     slot_select.selectedIndex = Number(slotIndex);
 
+  debug = getUrlParam("debug", "").length > 0;
+  if (debug) latency_debug.style.display = "block";
+
   diskAlerted = false;
   speed.value = 1.0;
   speed.oninput();